@@ -22,109 +22,485 @@ Created: 2024-10-31 with help from Claude.ai
 Version: 1.2.1
 """
 
+import io
 import os
+import mmap
+import queue
+import shutil
 import argparse
-from PIL import Image
-import numpy as np
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from PIL import Image, UnidentifiedImageError
 from pathlib import Path
 
+# pyspng is optional and the size prepass falls back to Pillow without it.
+# numpy is a dependency of pyspng and only used on that path, so a missing
+# numpy disables the pyspng path as well.
+try:
+    import numpy as np
+    import pyspng
+except ImportError:
+    pyspng = None
+
+# Modes without an alpha channel; unless a transparency key is set, every
+# pixel of these images is content
+OPAQUE_MODES = ('RGB', 'L', 'P')
+
+# Rows reduced at a time while searching for the first and last rows with content
+ROW_BAND = 64
+
+# Files in flight per worker between the reader, the workers and the writer;
+# bounds how many file contents and encoded outputs are held in memory
+PIPELINE_DEPTH = 2
+
 def get_next_power_of_2(n):
     """Return the next power of 2 that is >= n"""
     n = int(n)
-    return 1 if n == 0 else 2 ** (n - 1).bit_length()
+    return 1 << (n - 1).bit_length() if n > 1 else 1
 
 def get_content_bounds(im):
     """Get the bounds of non-transparent content in RGBA image"""
-    # Convert image to numpy array
-    img_array = np.array(im)
+    # Pillow scans the alpha channel in C and returns None when the
+    # image is completely transparent
+    return im.getbbox()
+
+def get_array_bounds(alpha):
+    """Get the bounds of non-transparent content from an alpha channel array"""
+    height, width = alpha.shape
     
-    # Get alpha channel
-    alpha = img_array[:, :, 3]
+    # Content touching all four edges spans the whole image, as in fully
+    # opaque images, so checking the border pixels can skip the full scan
+    if alpha[0].any() and alpha[-1].any() and alpha[:, 0].any() and alpha[:, -1].any():
+        return 0, 0, width, height
     
-    # Find non-transparent pixels
-    non_transparent = alpha > 0
+    # A channel view of an RGBA array strides over all four channels; a
+    # contiguous copy lets the reductions below walk memory with unit stride
+    alpha = np.ascontiguousarray(alpha)
     
-    if not np.any(non_transparent):
+    # Scan bands of rows down from the top and stop at the first one with
+    # non-transparent pixels; any() treats nonzero alpha as True, so no
+    # boolean copy of the plane is needed
+    for y in range(0, height, ROW_BAND):
+        rows = np.any(alpha[y:y + ROW_BAND], axis=1)
+        if rows.any():
+            # argmax stops at the first True, so no index arrays are allocated
+            top = y + int(np.argmax(rows))
+            break
+    else:
         return None  # Image is completely transparent
     
-    # Get bounds
-    rows = np.any(non_transparent, axis=1)
-    cols = np.any(non_transparent, axis=0)
+    # Same from the bottom up; the band holding the top row always has content
+    for y in range(height, top, -ROW_BAND):
+        rows = np.any(alpha[max(y - ROW_BAND, top):y], axis=1)
+        if rows.any():
+            # Found on the reversed mask, bottom is exclusive
+            bottom = y - int(np.argmax(rows[::-1]))
+            break
     
-    top, bottom = np.where(rows)[0][[0, -1]]
-    left, right = np.where(cols)[0][[0, -1]]
+    # Columns only need to be reduced over the rows holding content
+    cols = np.any(alpha[top:bottom], axis=0)
+    left = int(np.argmax(cols))
+    right = len(cols) - int(np.argmax(cols[::-1]))
     
-    return left, top, right + 1, bottom + 1
+    return left, top, right, bottom
 
-def get_max_content_dimensions(png_files):
-    """Calculate the maximum content dimensions across all PNG files"""
-    max_width = 0
-    max_height = 0
+def prepare_image(im):
+    """Return the image to crop from together with its content bounds"""
+    if im.mode in OPAQUE_MODES and 'transparency' not in im.info:
+        # Fully opaque, so the whole image is content and no RGBA copy is needed
+        return im, (0, 0, im.width, im.height)
     
-    for file_path in png_files:
+    # Convert to RGBA if not already
+    if im.mode != 'RGBA':
+        im = im.convert('RGBA')
+    
+    return im, get_content_bounds(im)
+
+def share_content(data, size):
+    """Copy RGBA content bytes into shared memory and return a picklable handle to them
+    
+    Passing the handle instead of the pixels keeps decoded content from being
+    pickled on its way between the worker processes. Returns None if the
+    shared memory is full, in which case the file is decoded again later.
+    """
+    try:
+        shm = SharedMemory(create=True, size=len(data))
+    except OSError:
+        return None
+    
+    # Reserve the pages up front where the platform allows it, so a full
+    # /dev/shm raises here instead of killing the worker with SIGBUS on write
+    if hasattr(os, 'posix_fallocate'):
         try:
-            with Image.open(file_path) as im:
-                if im.mode != 'RGBA':
-                    im = im.convert('RGBA')
-                
-                bounds = get_content_bounds(im)
-                if bounds is not None:
-                    left, top, right, bottom = bounds
-                    content_width = right - left
-                    content_height = bottom - top
-                    max_width = max(max_width, content_width)
-                    max_height = max(max_height, content_height)
-                    
-        except Exception as e:
-            print(f"Error processing {file_path} during size calculation: {e}")
+            os.posix_fallocate(shm._fd, 0, len(data))
+        except OSError:
+            shm.close()
+            shm.unlink()
+            return None
     
-    return max_width, max_height
+    shm.buf[:len(data)] = data
+    shm.close()
+    return shm.name, size
 
-def process_image(input_path, output_dir, target_width=None, target_height=None):
-    """Process a single image"""
+def load_content(handle):
+    """Return a copy of the RGBA content behind a share_content handle"""
+    name, size = handle
+    shm = SharedMemory(name=name)
     try:
-        # Open image
-        with Image.open(input_path) as im:
-            # Convert to RGBA if not already
-            if im.mode != 'RGBA':
-                im = im.convert('RGBA')
-            
-            # Get content bounds
-            bounds = get_content_bounds(im)
+        return Image.frombytes('RGBA', size, shm.buf[:size[0] * size[1] * 4])
+    finally:
+        shm.close()
+
+def release_content(handle):
+    """Free the shared memory behind a share_content handle"""
+    try:
+        shm = SharedMemory(name=handle[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def shared_size(width, height):
+    """Return the bytes a shared memory segment of RGBA content occupies
+    
+    Segments are allocated in whole pages, which dominates for small crops.
+    """
+    return -(-width * height * 4 // mmap.PAGESIZE) * mmap.PAGESIZE
+
+def content_fits(bounds, budget):
+    """Return whether the RGBA content inside bounds fits in budget bytes"""
+    left, top, right, bottom = bounds
+    return shared_size(right - left, bottom - top) <= budget
+
+def scan_file(file_path, budget=0):
+    """Decode a single PNG file and return its size, content bounds and shared content
+    
+    The cropped content is returned as a share_content handle, which the
+    caller has to free with release_content, or None if it doesn't fit in
+    budget bytes.
+    """
+    try:
+        with Image.open(file_path) as im:
+            # Opening only reads the PNG header, so the mode is known before
+            # any pixel data is decoded. pyspng ignores tRNS chunks, so it is
+            # only used for images with a real alpha channel.
+            if pyspng is not None and im.mode in ('RGBA', 'LA'):
+                data = Path(file_path).read_bytes()
+                rgba = pyspng.load(data, 'RGBA')
+                bounds = get_array_bounds(rgba[:, :, 3])
+                if bounds is None or not content_fits(bounds, budget):
+                    return im.size, bounds, None
+                left, top, right, bottom = bounds
+                content = rgba[top:bottom, left:right].tobytes()
+                return im.size, bounds, share_content(content, (right - left, bottom - top))
             
-            if bounds is None:
-                print(f"Skipping {input_path} - completely transparent")
-                return
+            im, bounds = prepare_image(im)
+            if bounds is None or not content_fits(bounds, budget):
+                return im.size, bounds, None
             
+            # Shared content is always RGBA, which is what paste() would
+            # convert it to anyway
+            content = im.crop(bounds)
+            if content.mode != 'RGBA':
+                content = content.convert('RGBA')
+            return im.size, bounds, share_content(content.tobytes(), content.size)
+    except Exception as e:
+        print(f"Error processing {file_path} during size calculation: {e}")
+        return None
+
+def get_max_content_dimensions(png_files, executor, workers, memory_limit=0, handles=None):
+    """Calculate the maximum content dimensions across all PNG files
+    
+    Also returns the scan of each file so it doesn't have to be decoded
+    again when the files are processed. Cropped content is only kept in
+    shared memory while its total size stays within memory_limit bytes.
+    The handles of all shared content are appended to handles as soon as
+    they are received, and the caller frees them with release_content.
+    """
+    max_width = 0
+    max_height = 0
+    file_scans = {}
+    handles = handles if handles is not None else []
+    
+    # Shared memory is backed by /dev/shm on Linux, which can be far smaller
+    # than the requested ceiling (64 MB in Docker by default)
+    if os.path.isdir('/dev/shm'):
+        memory_limit = min(memory_limit, shutil.disk_usage('/dev/shm').free // 2)
+    
+    # Every scan in flight reserves an equal share of the ceiling up front,
+    # and workers only create segments that fit in their share
+    max_pending = PIPELINE_DEPTH * workers
+    share = memory_limit // max_pending
+    available = memory_limit
+    
+    def collect(future):
+        nonlocal max_width, max_height, available
+        file_path, budget = pending.pop(future)
+        available += budget
+        scan = future.result()
+        if scan is None:
+            return
+        
+        size, bounds, handle = scan
+        if handle is not None:
+            handles.append(handle)
+            content_width, content_height = handle[1]
+            available -= shared_size(content_width, content_height)
+        file_scans[file_path] = scan
+        
+        if bounds is not None:
             left, top, right, bottom = bounds
-            
-            # Calculate required dimensions
-            content_width = right - left
-            content_height = bottom - top
-            
-            # Use target dimensions if provided, otherwise calculate from content
+            max_width = max(max_width, right - left)
+            max_height = max(max_height, bottom - top)
+    
+    pending = {}
+    try:
+        for file_path in png_files:
+            budget = min(share, available)
+            available -= budget
+            pending[executor.submit(scan_file, file_path, budget)] = file_path, budget
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+        
+        for future in list(pending):
+            collect(future)
+    finally:
+        # If collecting failed, still pick up content the remaining scans
+        # shared so the caller can free it
+        for future in pending:
+            try:
+                scan = future.result()
+            except Exception:
+                continue
+            if scan is not None and scan[2] is not None:
+                handles.append(scan[2])
+    
+    return max_width, max_height, file_scans
+
+def needs_decode(scan):
+    """Return whether a file has to be decoded again after the size prepass"""
+    return scan is None or (scan[1] is not None and scan[2] is None)
+
+def open_image(input_path, data=None):
+    """Open an image from its already read file contents, or from its path"""
+    if data is None:
+        return Image.open(input_path)
+    
+    try:
+        return Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        # Name the file, as opening by path does, instead of the buffer
+        raise UnidentifiedImageError(f"cannot identify image file {str(input_path)!r}") from None
+
+def process_image(input_path, data=None, target_width=None, target_height=None, exact=False,
+                  scan=None, compress_level=1):
+    """Process a single image and return its output file name, encoded PNG and sizes
+    
+    data holds the file contents if they were already read, and scan the
+    result of scan_file if the file went through the size prepass. Returns
+    None if there is nothing to save.
+    """
+    input_path = Path(input_path)
+    try:
+        if needs_decode(scan):
+            # Open image
+            with open_image(input_path, data) as im:
+                if scan is None:
+                    # Get content bounds, converting to RGBA only when needed
+                    im, bounds = prepare_image(im)
+                else:
+                    bounds = scan[1]
+                size = im.size
+                content = im.crop(bounds) if bounds is not None else None
+        else:
+            # Content was already decoded by the size prepass
+            size, bounds, handle = scan
+            content = load_content(handle) if handle is not None else None
+        
+        if bounds is None:
+            print(f"Skipping {input_path} - completely transparent")
+            return None
+        
+        # Calculate required dimensions
+        content_width, content_height = content.size
+        
+        # Use target dimensions if provided, otherwise calculate from content
+        if exact:
+            new_width = target_width if target_width else content_width
+            new_height = target_height if target_height else content_height
+        else:
             new_width = target_width if target_width else get_next_power_of_2(content_width)
             new_height = target_height if target_height else get_next_power_of_2(content_height)
-            
+        
+        if (new_width, new_height) == content.size:
+            # The content fills the output exactly, so the crop itself is
+            # the output and no canvas has to be allocated and copied into
+            new_im = content if content.mode == 'RGBA' else content.convert('RGBA')
+        else:
             # Center the content in the new dimensions
             new_left = (new_width - content_width) // 2
             new_top = (new_height - content_height) // 2
             
-            # Create new image with power of 2 dimensions
-            new_im = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
+            # Create new image with power of 2 dimensions, zero filled so
+            # everything around the content is fully transparent
+            new_im = Image.new('RGBA', (new_width, new_height))
             
-            # Paste the content
-            content = im.crop(bounds)
-            new_im.paste(content, (new_left, new_top))
+            # Paste the content as a straight copy, without alpha compositing
+            new_im.paste(content, (new_left, new_top), mask=None)
+        
+        # Encode in the worker, the writer only has to put the bytes on disk
+        output = io.BytesIO()
+        new_im.save(output, 'PNG', compress_level=compress_level, optimize=False)
+        
+        return input_path.name, output.getvalue(), size, new_im.size
+        
+    except Exception as e:
+        print(f"Error processing {input_path}: {e}")
+        return None
+
+def write_outputs(write_queue, output_dir, written, errors, verbose=False):
+    """Write encoded PNGs from the queue to the output directory until a None arrives
+    
+    The names of successfully written files are appended to written. The
+    loop keeps draining the queue whatever fails, so the producer can never
+    block on a full queue; unexpected errors, such as stdout being closed,
+    are appended to errors for the producer to re-raise.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        
+        try:
+            name, png, size, new_size = item
+            try:
+                (Path(output_dir) / name).write_bytes(png)
+            except OSError as e:
+                print(f"Error writing {name}: {e}")
+                continue
             
-            # Save to output directory
-            output_path = output_dir / input_path.name
-            new_im.save(output_path, 'PNG')
+            written.append(name)
+            if verbose:
+                print(f"Processed {name}: {size} -> {new_size}")
+        except Exception as e:
+            errors.append(e)
+
+def process_files(png_files, output_dir, executor, workers, file_scans=None, verbose=False,
+                  **kwargs):
+    """Crop all PNG files with a reader, worker pool and writer pipeline
+    
+    The calling thread reads files and hands them to the workers, which
+    decode, crop and encode them, while a writer thread saves the results.
+    At most PIPELINE_DEPTH files per worker are in flight at a time. Only
+    the writer reports processed files, so workers don't contend for stdout.
+    Returns the number of cropped images.
+    """
+    file_scans = file_scans or {}
+    max_pending = PIPELINE_DEPTH * workers
+    write_queue = queue.Queue(maxsize=max_pending)
+    written = []
+    errors = []
+    writer = threading.Thread(target=write_outputs,
+                              args=(write_queue, output_dir, written, errors, verbose))
+    writer.start()
+    
+    def drain(futures):
+        for future in futures:
+            result = future.result()
+            if result is not None:
+                write_queue.put(result)
+        
+        # Stop feeding the pipeline once the writer has failed
+        if errors:
+            raise errors[0]
+    
+    try:
+        pending = set()
+        for file_path in png_files:
+            scan = file_scans.get(file_path)
+            try:
+                data = file_path.read_bytes() if needs_decode(scan) else None
+            except OSError as e:
+                print(f"Error processing {file_path}: {e}")
+                continue
             
-            print(f"Processed {input_path.name}: {im.size} -> {new_im.size}")
+            pending.add(executor.submit(process_image, str(file_path), data, scan=scan, **kwargs))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                drain(done)
+        
+        drain(pending)
+    finally:
+        write_queue.put(None)
+        writer.join()
+    
+    if errors:
+        raise errors[0]
+    
+    return len(written)
+
+def process_batch(png_files, output_dir, mode='individual', exact=False, workers=None,
+                  compress_level=1, memory_limit=0, verbose=False):
+    """Crop a batch of PNG files into output_dir and return the number of cropped images
+    
+    mode is 'individual' to size every image by its own content, or 'uniform'
+    to give all images the size of the largest content. memory_limit is the
+    number of bytes of decoded content kept in shared memory between the two
+    uniform passes, which is only done on POSIX systems.
+    """
+    png_files = [Path(f) for f in png_files]
+    
+    # Create output directory
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True)
+    
+    # Handle different modes
+    target_width = None
+    target_height = None
+    
+    file_scans = {}
+    shared = []
+    
+    # Content is only shared between passes on POSIX systems. On Windows a
+    # segment disappears once the worker that created it closes its handle,
+    # and the resource tracker can't be started there.
+    share = mode == 'uniform' and os.name == 'posix'
+    if share:
+        # Workers create the shared memory and this process frees it, so they
+        # have to share one resource tracker, which forked workers only do if
+        # it is already running
+        resource_tracker.ensure_running()
+    
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            if mode == 'uniform' and png_files:
+                max_width, max_height, file_scans = get_max_content_dimensions(
+                    png_files, executor, workers, memory_limit if share else 0, shared)
+                if exact:
+                    target_width = max_width
+                    target_height = max_height
+                else:
+                    target_width = get_next_power_of_2(max_width)
+                    target_height = get_next_power_of_2(max_height)
+                    
+                pow2text = "exact" if exact else "(power-of-two)"        
+                print(f"Using uniform size {pow2text} for all images: {target_width}x{target_height}")
             
-    except Exception as e:
-        print(f"Error processing {input_path}: {e}")
+            # Process all PNG files in parallel; in individual mode each worker
+            # derives its own target dimensions from the image content
+            return process_files(png_files, output_dir, executor, workers, file_scans,
+                                 verbose=verbose,
+                                 target_width=target_width, target_height=target_height,
+                                 exact=exact, compress_level=compress_level)
+        finally:
+            # Free the content shared by the uniform prepass
+            for handle in shared:
+                release_content(handle)
 
 def main():
     # Set up main parser
@@ -133,6 +509,10 @@ def main():
     # Add exact flag to main parser for default (individual) mode
     parser.add_argument('--exact', action='store_true',
                        help='Use exact dimensions instead of rounding to power of 2')
+    parser.add_argument('--compress-level', type=int, default=1, choices=range(10), metavar='N',
+                       help='PNG zlib compression level, 0-9 (default: 1, fastest)')
+    parser.add_argument('--verbose', action='store_true',
+                       help='Print the sizes of every processed image')
     
     # Create subparsers for different modes
     subparsers = parser.add_subparsers(dest='mode', help='Cropping mode')
@@ -141,53 +521,34 @@ def main():
     uniform_parser = subparsers.add_parser('uniform', help='Make all output images the same size based on the largest content')
     uniform_parser.add_argument('--exact', action='store_true',
                               help='Use exact dimensions instead of rounding to power of 2')
+    # Suppressed defaults keep values given before 'uniform' from being reset
+    uniform_parser.add_argument('--compress-level', type=int, default=argparse.SUPPRESS,
+                              choices=range(10), metavar='N',
+                              help='PNG zlib compression level, 0-9 (default: 1, fastest)')
+    uniform_parser.add_argument('--verbose', action='store_true', default=argparse.SUPPRESS,
+                              help='Print the sizes of every processed image')
+    uniform_parser.add_argument('--memory', type=int, default=1024,
+                              help='Megabytes of decoded content to keep in memory between the '
+                                   'size calculation and cropping (default: 1024)')
     
     args = parser.parse_args()
     
     # Get the directory containing the script
     script_dir = Path(__file__).parent
     
-    # Create output directory
     output_dir = script_dir / 'cropped'
-    output_dir.mkdir(exist_ok=True)
     
     # Get list of PNG files
     png_files = [f for f in script_dir.glob('*.png') if f.is_file()]
     
-    # Handle different modes
-    target_width = None
-    target_height = None
+    # Only uniform mode keeps decoded content between passes
+    memory_limit = args.memory * 1024 * 1024 if args.mode == 'uniform' else 0
     
-    if args.mode == 'uniform' and png_files:
-        max_width, max_height = get_max_content_dimensions(png_files)
-        if args.exact:
-            target_width = max_width
-            target_height = max_height
-        else:
-            target_width = get_next_power_of_2(max_width)
-            target_height = get_next_power_of_2(max_height)
-            
-        pow2text = "exact" if args.exact else "(power-of-two)"        
-        print(f"Using uniform size {pow2text} for all images: {target_width}x{target_height}")
-    
-    # Process all PNG files
-    for file_path in png_files:
-        if args.mode != 'uniform' and args.exact:
-            # For individual exact mode, we need to calculate the content size for each image
-            with Image.open(file_path) as im:
-                if im.mode != 'RGBA':
-                    im = im.convert('RGBA')
-                bounds = get_content_bounds(im)
-                if bounds is not None:
-                    left, top, right, bottom = bounds
-                    target_width = right - left
-                    target_height = bottom - top
-        
-        process_image(file_path, output_dir, target_width, target_height)
-        # Reset target dimensions for next file in individual mode
-        if args.mode != 'uniform':
-            target_width = None
-            target_height = None
+    cropped = process_batch(png_files, output_dir, mode=args.mode or 'individual',
+                            exact=args.exact, compress_level=args.compress_level,
+                            memory_limit=memory_limit, verbose=args.verbose)
+    
+    print(f"Cropped {cropped} of {len(png_files)} images into {output_dir}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file